@@ -3,20 +3,51 @@ import streamlit as st
 import sqlite3
 import os
 import hashlib
+import functools
 import time
-from model import tokenizer, model  # Import from our model module
+import queue
+import threading
+import atexit
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from model import tokenizer, model, dtype  # Import from our model module
 import torch
-from transformers import pipeline
-from contextlib import closing
+
+logger = logging.getLogger(__name__)
 
 # ===== Configuration =====
 DB_PATH = "contract_analytics.db"
-MAX_INPUT_LENGTH = 10000  # Characters
+MAX_INPUT_LENGTH = 10000  # Characters; coarse cap before token truncation
+MAX_INPUT_TOKENS = 1024  # BART encoder positions
+UPLOAD_CHUNK_SIZE = 64 * 1024  # Bytes per read from an uploaded file
 HISTORY_LIMIT = 50
+DEFAULT_NUM_BEAMS = 1  # Greedy decoding; raise for quality over speed
+MAX_NUM_BEAMS = 4
+RESULT_CACHE_SIZE = 128  # Stored analyses kept in memory by text hash
+BATCH_MAX_SIZE = 8  # Requests coalesced into one generate() call
+BATCH_MAX_WAIT_MS = 50  # How long the first request waits for company
+MAX_LENGTH_STEP = 25  # Summary lengths are rounded up to these steps so
+MIN_LENGTH_STEP = 10  # similar-sized documents can share a batch
 
 # ===== Database Setup =====
+@st.cache_resource
+def get_db():
+    """One SQLite connection, and the lock guarding it, shared by every session"""
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")  # Persisted in the database file
+    conn.execute("PRAGMA synchronous=NORMAL")  # Per connection, so set once here
+    return conn, threading.Lock()
+
+@st.cache_resource
+def get_db_writer():
+    """Single background thread that applies writes in submission order"""
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+    atexit.register(executor.shutdown, wait=True)  # Flush queued writes on exit
+    return executor
+
 def init_db():
-    with closing(sqlite3.connect(DB_PATH)) as conn:
+    conn, lock = get_db()
+    with lock, conn:
         conn.execute("""
         CREATE TABLE IF NOT EXISTS analyses (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -24,103 +55,316 @@ def init_db():
             text_hash TEXT NOT NULL UNIQUE,
             original_length INTEGER,
             summary TEXT,
-            processing_time REAL
+            processing_time REAL,
+            num_beams INTEGER NOT NULL DEFAULT 4
         )
         """)
+        # Databases from before beam widths were stored; their rows came from 4-beam search
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(analyses)")}
+        if "num_beams" not in columns:
+            conn.execute("ALTER TABLE analyses ADD COLUMN num_beams INTEGER NOT NULL DEFAULT 4")
         conn.execute("""
         CREATE TABLE IF NOT EXISTS document_texts (
             text_hash TEXT PRIMARY KEY,
             content TEXT NOT NULL
         )
         """)
-        conn.commit()
+        # text_hash lookups already use the index behind its UNIQUE constraint
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_analyses_created_at ON analyses(created_at DESC)")
 
 # ===== Summarization Service =====
-class SummarizationEngine:
-    _instance = None
+def round_up(value: int, step: int) -> int:
+    return -(-value // step) * step
+
+class DynamicBatcher:
+    """Coalesce concurrent requests into batched calls on a single worker thread"""
+    
+    def __init__(self, batch_fn, max_batch=BATCH_MAX_SIZE, max_wait_ms=BATCH_MAX_WAIT_MS):
+        self.batch_fn = batch_fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name="summarization-batcher", daemon=True)
+        self._worker.start()
     
+    def submit(self, item, **kwargs) -> Future:
+        """Queue one item; the future resolves to its entry in the batch result"""
+        future = Future()
+        self._queue.put((item, kwargs, future))
+        return future
+    
+    def _collect(self) -> list:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+    
+    def _run(self):
+        while True:
+            # One call shares its generation settings, so group by them
+            groups = {}
+            for item, kwargs, future in self._collect():
+                groups.setdefault(tuple(sorted(kwargs.items())), []).append((item, future))
+            
+            for key, entries in groups.items():
+                try:
+                    results = self.batch_fn([item for item, _ in entries], **dict(key))
+                except Exception as e:
+                    for _, future in entries:
+                        future.set_exception(e)
+                else:
+                    for (_, future), result in zip(entries, results):
+                        future.set_result(result)
+
+class SummarizationEngine:
     def __init__(self):
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        st.toast(f"Using {'GPU 🔥' if self.device == 'cuda' else 'CPU ⚙️'} acceleration")
         
-        self.model = model.to(self.device)
+        self.model = model.to(self.device)  # Already frozen in eval mode by model.py
+        # Compile forward() rather than the module: generate() calls it once per decode step.
+        # Keep the eager forward to fall back on, since compilation only fails at the first call.
+        self._eager_forward = self.model.forward
+        # GPU only: on CPU, compiling measured no faster than eager while recompiling for every
+        # new input length, and Dynamo can't trace the INT8-quantized Linear layers at all
+        if self.device == "cuda":
+            self.model.forward = torch.compile(self.model.forward, mode="reduce-overhead", fullgraph=False)
         self.tokenizer = tokenizer
-        self.summarizer = pipeline(
-            "summarization",
-            model=self.model,
-            tokenizer=self.tokenizer,
-            device=0 if self.device == "cuda" else -1
-        )
+        self.max_input_tokens = min(self.tokenizer.model_max_length, MAX_INPUT_TOKENS)
+        
+        # Task setup the summarization pipeline used to apply, e.g. T5's "summarize: " prefix.
+        # Explicit generate() arguments below still take precedence over these defaults.
+        task_params = dict((self.model.config.task_specific_params or {}).get("summarization", {}))
+        self.prefix = task_params.pop("prefix", None) or getattr(self.model.config, "prefix", None) or ""
+        self.model.generation_config.update(**task_params)
+        self.batcher = DynamicBatcher(self._summarize_batch)
+        self._cached_result = functools.lru_cache(maxsize=RESULT_CACHE_SIZE)(self._cached_result)
+        self._cache_lock = threading.Lock()  # Orders lookups against forget_cached_results()
+    
+    def _warmup(self):
+        """Compile on one short batch-1 input, falling back to eager if compilation fails
+
+        Other batch sizes and sequence lengths still compile on first use.
+        """
+        warmup_ids = self.tokenizer("warmup " * 64).input_ids
+        try:
+            self.batcher.submit(warmup_ids, max_length=30, min_length=10, num_beams=DEFAULT_NUM_BEAMS).result()
+        except Exception:
+            logger.exception("torch.compile failed during warmup, running the model eagerly")
+            self.model.forward = self._eager_forward
+    
+    def _summarize_batch(self, token_ids: list, max_length: int, min_length: int, num_beams: int) -> list:
+        """Summarize a batch of tokenized texts in one generate() call (runs on the batcher thread)"""
+        inputs = self.tokenizer.pad({"input_ids": token_ids}, return_tensors="pt")
+        if self.device == "cuda":
+            # Pinned host memory lets the copy run asynchronously; generate() orders after it on the same stream
+            inputs = {k: v.pin_memory().to(self.device, non_blocking=True) for k, v in inputs.items()}
+        
+        # Grad and autocast state are thread-local, so they are set here rather than by callers
+        # Autocast keeps activations in the weight dtype (no-op on CPU)
+        autocast = torch.autocast(device_type=self.device, dtype=dtype, enabled=self.device == "cuda")
+        with torch.inference_mode(), autocast:
+            output_ids = self.model.generate(
+                **inputs,
+                max_new_tokens=max_length,
+                min_new_tokens=min_length,
+                num_beams=num_beams,
+                do_sample=False,
+                no_repeat_ngram_size=3,
+                length_penalty=1.0,
+                early_stopping=num_beams > 1,  # Only meaningful for beam search
+                use_cache=True
+            )
+        return self.tokenizer.batch_decode(output_ids, skip_special_tokens=True)
     
-    @classmethod
-    def get_instance(cls):
-        if cls._instance is None:
-            cls._instance = SummarizationEngine()
-        return cls._instance
+    def _cached_result(self, text_hash: str, num_beams: int) -> dict:
+        """Build a result from a stored analysis; raises KeyError on a miss so misses aren't memoized"""
+        row = get_analysis_by_hash(text_hash, num_beams)
+        if row is None:
+            raise KeyError((text_hash, num_beams))
+        summary, original_length = row
+        return {
+            "summary": summary,
+            "original_length": original_length,
+            "summary_length": len(summary),
+            "compression_ratio": original_length / max(1, len(summary)),
+            "processing_time": 0.0,
+            "text_hash": text_hash,
+            "num_beams": num_beams,
+            "cache_hit": True
+        }
+    
+    def forget_cached_results(self):
+        """Drop memoized analyses once a save has replaced the stored row they were read from"""
+        with self._cache_lock:
+            self._cached_result.cache_clear()
     
-    def summarize(self, text: str) -> dict:
+    def summarize(self, text: str, num_beams: int = DEFAULT_NUM_BEAMS) -> dict:
         """Generate summary with performance metrics"""
         start_time = time.time()
         
-        # Preprocessing
-        clean_text = text.strip()[:MAX_INPUT_LENGTH]
+        # Preprocessing: truncate to what the encoder can attend to, tokenizing only once
+        input_ids = self.tokenizer(
+            self.prefix + text.strip()[:MAX_INPUT_LENGTH],
+            truncation=True,
+            max_length=self.max_input_tokens
+        ).input_ids
+        clean_text = self.tokenizer.decode(input_ids, skip_special_tokens=True)
+        if self.prefix and clean_text.startswith(self.prefix):
+            clean_text = clean_text[len(self.prefix):]
         
-        # Dynamic length adjustment
-        input_length = len(clean_text.split())
-        max_length = min(300, max(50, int(input_length * 0.3)))
-        min_length = min(100, max(30, int(input_length * 0.1)))
+        # Reuse the stored summary for documents we've already analyzed at this beam width
+        text_hash = hash_text(clean_text)
+        try:
+            with self._cache_lock:
+                cached = self._cached_result(text_hash, num_beams)
+            return dict(cached)
+        except KeyError:
+            pass
         
-        # Generate summary
-        with torch.no_grad():
-            summary_result = self.summarizer(
-                clean_text,
-                max_length=max_length,
-                min_length=min_length,
-                do_sample=False,
-                truncation=True
-            )
+        # Dynamic length adjustment, bucketed so concurrent requests batch together
+        input_length = len(input_ids)
+        max_length = min(300, round_up(max(50, int(input_length * 0.3)), MAX_LENGTH_STEP))
+        min_length = min(100, round_up(max(30, int(input_length * 0.1)), MIN_LENGTH_STEP))
+        
+        # Generate summary (batched with any concurrent requests)
+        summary = self.batcher.submit(
+            input_ids, max_length=max_length, min_length=min_length, num_beams=num_beams
+        ).result()
         
         processing_time = time.time() - start_time
         return {
-            "summary": summary_result[0]['summary_text'],
+            "summary": summary,
             "original_length": len(clean_text),
-            "summary_length": len(summary_result[0]['summary_text']),
-            "compression_ratio": len(clean_text) / max(1, len(summary_result[0]['summary_text'])),
-            "processing_time": processing_time
+            "summary_length": len(summary),
+            "compression_ratio": len(clean_text) / max(1, len(summary)),
+            "processing_time": processing_time,
+            "text_hash": text_hash,
+            "num_beams": num_beams,
+            "cache_hit": False
         }
 
+@st.cache_resource
+def get_summarizer():
+    """One engine (and one copy of the weights) per server process, shared by all sessions"""
+    engine = SummarizationEngine()
+    engine._warmup()
+    return engine
+
 # ===== Database Operations =====
-def save_analysis(text: str, result: dict):
-    text_hash = hashlib.sha256(text.encode()).hexdigest()
+def hash_text(text: str) -> str:
+    # Only a content fingerprint, so a fast digest is sufficient; BLAKE2b is still collision-resistant.
+    # Rows saved before the switch from SHA-256 keep their old hashes and simply won't match.
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+def get_analysis_by_hash(text_hash: str, num_beams: int):
+    conn, lock = get_db()
+    with lock:
+        return conn.execute(
+            "SELECT summary, original_length FROM analyses WHERE text_hash = ? AND num_beams = ? LIMIT 1",
+            (text_hash, num_beams)
+        ).fetchone()
+
+def _log_save_error(future: Future):
+    if future.exception() is not None:
+        logger.error("Saving analysis failed", exc_info=future.exception())
+
+def save_analysis(text: str, result: dict) -> Future:
+    """Queue the analysis for the background writer and return without waiting"""
+    future = get_db_writer().submit(_save_analysis_sync, text, result)
+    future.add_done_callback(_log_save_error)
+    return future
+
+def _save_analysis_sync(text: str, result: dict):
+    text_hash = result["text_hash"]
     
-    with closing(sqlite3.connect(DB_PATH)) as conn:
+    conn, lock = get_db()
+    with lock, conn:  # Commits both inserts together, rolls back on error
         # Store original text separately
         conn.execute(
             "INSERT OR IGNORE INTO document_texts (text_hash, content) VALUES (?, ?)",
             (text_hash, text)
         )
         
-        # Save analysis metadata
+        # Save analysis metadata; one row per document, replaced when re-run at another beam width
         conn.execute(
             """INSERT INTO analyses (
-                text_hash, original_length, summary, processing_time
-            ) VALUES (?, ?, ?, ?)""",
-            (text_hash, result["original_length"], result["summary"], result["processing_time"])
+                text_hash, original_length, summary, processing_time, num_beams
+            ) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(text_hash) DO UPDATE SET
+                created_at = CURRENT_TIMESTAMP,
+                original_length = excluded.original_length,
+                summary = excluded.summary,
+                processing_time = excluded.processing_time,
+                num_beams = excluded.num_beams""",
+            (text_hash, result["original_length"], result["summary"], result["processing_time"], result["num_beams"])
         )
-        conn.commit()
 
 def get_recent_analyses(limit=10):
-    with closing(sqlite3.connect(DB_PATH)) as conn:
+    conn, lock = get_db()
+    with lock:
+        # Document text is left out; it's fetched on demand by get_original_text()
         cursor = conn.execute("""
-            SELECT a.id, a.created_at, a.original_length, a.summary, a.processing_time, d.content
-            FROM analyses a
-            JOIN document_texts d ON a.text_hash = d.text_hash
-            ORDER BY a.created_at DESC
+            SELECT id, created_at, original_length, summary, processing_time
+            FROM analyses
+            ORDER BY created_at DESC
             LIMIT ?
         """, (limit,))
         return cursor.fetchall()
 
+def get_history_stats(limit=10):
+    """Count, mean processing time and mean summary/original length ratio of the latest analyses"""
+    conn, lock = get_db()
+    with lock:
+        return conn.execute("""
+            SELECT COUNT(*), AVG(processing_time), AVG(CAST(LENGTH(summary) AS REAL) / original_length)
+            FROM (
+                SELECT summary, original_length, processing_time
+                FROM analyses
+                ORDER BY created_at DESC
+                LIMIT ?
+            )
+        """, (limit,)).fetchone()
+
+def get_original_text(analysis_id: int):
+    conn, lock = get_db()
+    with lock:
+        row = conn.execute("""
+            SELECT d.content
+            FROM analyses a
+            JOIN document_texts d ON a.text_hash = d.text_hash
+            WHERE a.id = ?
+        """, (analysis_id,)).fetchone()
+    return row[0] if row else None
+
 # ===== Streamlit UI =====
+def report_pending_saves():
+    """Show failures of this session's background saves queued on earlier reruns"""
+    pending = st.session_state.setdefault("pending_saves", [])
+    for future in [f for f in pending if f.done()]:
+        pending.remove(future)
+        if future.exception() is not None:
+            st.error(f"Saving an earlier analysis failed: {str(future.exception())}")
+
+def read_upload(uploaded_file) -> str:
+    """Read only as much of an upload as can survive MAX_INPUT_LENGTH truncation"""
+    # UTF-8 uses at most 4 bytes per character
+    byte_limit = MAX_INPUT_LENGTH * 4
+    buf = bytearray()
+    while len(buf) < byte_limit:
+        chunk = uploaded_file.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        buf += chunk
+    # errors="ignore" drops a multi-byte character split at the read boundary
+    return buf.decode("utf-8", errors="ignore")[:MAX_INPUT_LENGTH]
+
 def main():
     # Initialize app
     st.set_page_config(
@@ -129,7 +373,12 @@ def main():
         layout="wide"
     )
     init_db()
-    summarizer = SummarizationEngine.get_instance()
+    report_pending_saves()
+    summarizer = get_summarizer()
+    # Announced here rather than in the cached constructor, whose elements Streamlit would replay
+    if not st.session_state.get("device_announced"):
+        st.toast(f"Using {'GPU 🔥' if summarizer.device == 'cuda' else 'CPU ⚙️'} acceleration")
+        st.session_state.device_announced = True
     
     # Custom CSS
     st.markdown("""
@@ -154,6 +403,13 @@ def main():
     st.title("⚖️ LegalMind AI - Contract Analyzer")
     st.caption("AI-powered contract summarization for legal professionals")
     
+    # Decoding settings
+    num_beams = st.sidebar.slider(
+        "Beam search width", 1, MAX_NUM_BEAMS, DEFAULT_NUM_BEAMS,
+        help="1 is fast greedy decoding; wider beams are slower but can give better summaries. "
+             "Changing it re-summarizes documents stored at another width."
+    )
+    
     # Main content tabs
     tab1, tab2 = st.tabs(["Analyze Contract", "History & Insights"])
     
@@ -170,7 +426,7 @@ def main():
                                            help="Supports text, PDF, and Word documents")
             if uploaded_file:
                 if uploaded_file.type == "text/plain":
-                    text = uploaded_file.read().decode("utf-8")
+                    text = read_upload(uploaded_file)
                 else:
                     st.warning("PDF/Word support requires additional libraries. Using text input.")
         
@@ -188,7 +444,7 @@ def main():
             with st.spinner("Analyzing contract terms..."):
                 try:
                     # Process and summarize
-                    result = summarizer.summarize(text)
+                    result = summarizer.summarize(text, num_beams=num_beams)
                     
                     # Display results
                     st.subheader("AI Analysis Summary")
@@ -203,8 +459,14 @@ def main():
                     col3.metric("Compression Ratio", f"{result['compression_ratio']:.1f}:1")
                     
                     # Save results
-                    save_analysis(text, result)
-                    st.success("Analysis saved to database!")
+                    if result["cache_hit"]:
+                        st.info(f"Reused the stored summary of this document at beam width {result['num_beams']}")
+                    else:
+                        future = save_analysis(text, result)
+                        # The upsert may overwrite this document's summary at another width
+                        future.add_done_callback(lambda _: summarizer.forget_cached_results())
+                        st.session_state.pending_saves.append(future)
+                        st.success("Analysis queued for saving to history")
                     
                 except Exception as e:
                     st.error(f"Analysis failed: {str(e)}")
@@ -218,9 +480,7 @@ def main():
             st.info("No analysis history found")
         else:
             # Statistics dashboard
-            total_analyses = len(analyses)
-            avg_processing = sum(a[4] for a in analyses) / total_analyses
-            avg_compression = sum(len(a[3])/a[2] for a in analyses) / total_analyses
+            total_analyses, avg_processing, avg_compression = get_history_stats(HISTORY_LIMIT)
             
             st.metric("Total Analyses", total_analyses)
             cols = st.columns(2)
@@ -235,7 +495,7 @@ def main():
                     st.write("**Summary:**")
                     st.write(analysis[3])
                     if st.button("View Original", key=f"view_{analysis[0]}"):
-                        st.text_area("Full Text", analysis[5], height=300)
+                        st.text_area("Full Text", get_original_text(analysis[0]), height=300)
 
 # Run the application
 if __name__ == "__main__":
@@ -0,0 +1,79 @@
+# ---------- build_compiled_bart.py (offline) ----------
+# Exports the BART encoder with torch.export and compiles it ahead of time with
+# AOTInductor. model.py loads the resulting package on startup when it exists.
+#
+#   python build_compiled_bart.py
+#
+# Run it on the machine type you deploy to: the package is tied to the device,
+# dtype and torch version it was built with. Rebuild after changing MODEL_NAME.
+import os
+
+os.environ["QUANTIZE_CPU"] = "0"  # torch.export needs plain float Linear layers
+
+import torch
+import torch._inductor
+from torch.export import Dim
+from model import model, CompiledEncoder, DEVICE, COMPILED_MAX_BATCH, COMPILED_SEQ_RANGE, COMPILED_ENCODER_PATH
+
+# Autotuning settings; cudagraphs only apply on GPU
+INDUCTOR_CONFIGS = {
+    "max_autotune": True,
+    "coordinate_descent_tuning": True,
+    "coordinate_descent_check_all_directions": True,
+    "epilogue_fusion": False,
+}
+if DEVICE == "cuda":
+    INDUCTOR_CONFIGS["triton.cudagraphs"] = True
+
+class EncoderForExport(torch.nn.Module):
+    """Tensor-in, tensor-out view of the encoder that torch.export can trace"""
+
+    def __init__(self, encoder):
+        super().__init__()
+        self.encoder = encoder
+
+    def forward(self, input_ids, attention_mask):
+        return self.encoder(input_ids=input_ids, attention_mask=attention_mask, return_dict=False)[0]
+
+def quantize_fp8(module):
+    """FP8 weights and activations on H100-class GPUs, when torchao is installed"""
+    if DEVICE != "cuda" or torch.cuda.get_device_capability() < (8, 9):
+        return
+    try:
+        from torchao.quantization import quantize_, Float8DynamicActivationFloat8WeightConfig
+    except ImportError:
+        print("torchao not installed, skipping FP8 quantization")
+        return
+    quantize_(module, Float8DynamicActivationFloat8WeightConfig())
+
+def main():
+    model.eval().to(DEVICE)
+    encoder = model.get_encoder()
+    if isinstance(encoder, CompiledEncoder):  # Rebuilding over an existing package
+        encoder = encoder.encoder
+    encoder = EncoderForExport(encoder).eval()
+    quantize_fp8(encoder)
+
+    # Batch and sequence length stay dynamic within the range model.py routes to the package
+    min_seq, max_seq = COMPILED_SEQ_RANGE
+    batch = Dim("batch", min=1, max=COMPILED_MAX_BATCH)
+    seq = Dim("seq", min=min_seq, max=max_seq)
+    sample_ids = torch.randint(0, model.config.vocab_size, (2, 64), device=DEVICE)
+    sample_mask = torch.ones_like(sample_ids)
+
+    with torch.inference_mode():
+        exported = torch.export.export(
+            encoder,
+            args=(sample_ids, sample_mask),
+            dynamic_shapes={"input_ids": {0: batch, 1: seq}, "attention_mask": {0: batch, 1: seq}}
+        )
+        os.makedirs(os.path.dirname(COMPILED_ENCODER_PATH), exist_ok=True)
+        path = torch._inductor.aoti_compile_and_package(
+            exported,
+            package_path=COMPILED_ENCODER_PATH,
+            inductor_configs=INDUCTOR_CONFIGS
+        )
+    print(f"Compiled encoder written to {path}")
+
+if __name__ == "__main__":
+    main()